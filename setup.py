@@ -49,16 +49,13 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
-        "Programming Language :: Python :: 3.10",
-        "Programming Language :: Python :: 3.11",
         "Programming Language :: Python :: 3.12",
+        "Programming Language :: Python :: 3.13",
         "Topic :: Database :: Database Engines/Servers",
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
     # Requirements
-    python_requires=">=3.8, <4",
+    python_requires=">=3.12, <4",
     install_requires=[
         "sqlparse>=0.5.3",
         "anyio>=4.9.0",
@@ -75,6 +72,9 @@ setup(
             "sphinx>=8.2.3",
             "sphinx-rtd-theme>=3.0.2",
         ],
+        "speedups": [
+            "uvloop>=0.19.0; platform_system != 'Windows'",
+        ],
     },
     # Package data and configuration
     include_package_data=True,
@@ -1,19 +1,265 @@
-from asyncio import StreamReader, StreamWriter, wait_for
-from struct import pack
-from sqlite3 import connect, Error as SQLiteError
+from asyncio import (
+    IncompleteReadError,
+    StreamReader,
+    StreamWriter,
+    to_thread,
+    wait_for,
+)
+from functools import lru_cache
+from sqlite3 import Connection, Cursor, Error as SQLiteError
 from hashlib import sha1
+from typing import Awaitable, Callable, Optional
 
 from server import MySQLServer
-from errors import DatabaseError
+from errors import ConnectionError, DatabaseError, ProtocolError
 import logging
+import re
 
-# Configure logger
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 # MySQL capability flags
 CLIENT_PLUGIN_AUTH = 0x00080000  # Client supports authentication plugins
 
+# Rows fetched from SQLite and flushed to the client per batch
+FETCH_BATCH_SIZE = 4096
+
+# Largest handshake response accepted before the client is authenticated
+MAX_HANDSHAKE_SIZE = 4096
+
+# ASCII uppercase table for matching SQL keywords without decoding the query
+_TO_UPPER = bytes.maketrans(
+    b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+)
+
+# Statement keyword: the leading run of letters after any whitespace, so
+# "SELECT(1)" and "select*from t" dispatch like "SELECT 1"
+_VERB = re.compile(rb"\s*([A-Za-z]{1,16})")
+
+# Fixed packet payloads
+_OK = b"\x00\x00\x00\x02\x00\x00\x00"  # 0 rows, insert ID 0, autocommit
+_EOF = b"\xfe\x00\x00\x02\x00"  # 0 warnings, autocommit
+
+# Column definition fields after the names: utf8 charset, max length, BLOB type
+_COLUMN_DEF_TAIL = b"\x0c\x21\x00\xff\x00\x00\x00\xfc\x00\x00\x00\x00\x00"
+
+# SHOW DATABASES result set: a single "Database" column with one row
+_SHOW_DB_COUNT = b"\x01"
+_SHOW_DB_COLUMN_DEF = (
+    b"\x03def\x00\x00\x00\x08Database\x00"  # catalog "def", name "Database"
+    + _COLUMN_DEF_TAIL
+)
+_SHOW_DB_ROW = b"\x07sqlite3"
+
+
+async def _read_packet(
+    reader: StreamReader, timeout: float, max_length: int = 0xFFFFFF
+) -> tuple[int, bytes]:
+    """Read a single MySQL packet and return its sequence ID and payload.
+
+    Raises ProtocolError without reading the payload if the header announces
+    more than max_length bytes.
+    """
+    header = await wait_for(reader.readexactly(4), timeout=timeout)
+    packet_len = int.from_bytes(header[:3], "little")
+    if packet_len > max_length:
+        raise ProtocolError(f"Packet of {packet_len} bytes exceeds {max_length}")
+    payload = await wait_for(reader.readexactly(packet_len), timeout=timeout)
+    return header[3], payload
+
+
+def _emit(buf: bytearray, payload: bytes, sequence_id: int) -> int:
+    """Append a framed MySQL packet to buf and return the next sequence ID."""
+    if len(payload) > 0xFFFFFF:
+        raise ProtocolError("Payload exceeds MySQL packet size limit")
+    buf += len(payload).to_bytes(3, "little")
+    buf.append(sequence_id & 0xFF)
+    buf += payload
+    return sequence_id + 1
+
+
+async def _flush(writer: StreamWriter, buf: bytearray) -> None:
+    """Write a buffer of framed packets to the client in one go."""
+    try:
+        writer.write(buf)
+        await writer.drain()
+    except (OSError, TimeoutError) as e:
+        raise ConnectionError(f"Failed to send packet: {e}")
+
+
+def _lenenc_int(n: int) -> bytes:
+    """Encode n as a MySQL length-encoded integer."""
+    if n < 251:
+        return bytes((n,))
+    if n < 0x10000:
+        return b"\xfc" + n.to_bytes(2, "little")
+    if n < 0x1000000:
+        return b"\xfd" + n.to_bytes(3, "little")
+    return b"\xfe" + n.to_bytes(8, "little")
+
+
+def _encode_cell(val: object) -> Optional[bytes]:
+    """Encode a SQLite value as text protocol bytes, or None for NULL."""
+    if val is None:
+        return None
+    if isinstance(val, int):
+        return b"%d" % val
+    if isinstance(val, float):
+        return repr(val).encode()
+    if isinstance(val, bytes):
+        return val
+    return str(val).encode("utf-8")
+
+
+def _encode_row(row: tuple) -> bytes:
+    """Encode a result row as a sequence of length-encoded strings."""
+    buf = bytearray()
+    for val in row:
+        s = _encode_cell(val)
+        if s is None:
+            buf.append(0xFB)  # NULL
+            continue
+        n = len(s)
+        if n < 251:
+            buf.append(n)
+        else:
+            buf += _lenenc_int(n)
+        buf += s
+    return bytes(buf)
+
+
+@lru_cache(maxsize=256)
+def _column_defs_block(columns: tuple[str, ...], sequence_id: int) -> bytes:
+    """Frame the column count, column definitions and EOF of a result set.
+
+    Cached per column list so repeated queries of the same shape skip the
+    encoding; the caller advances its sequence ID by len(columns) + 2.
+    """
+    out = bytearray()
+    sequence_id = _emit(out, _lenenc_int(len(columns)), sequence_id)
+    for col in columns:
+        name = col.encode()
+        name = _lenenc_int(len(name)) + name
+        # catalog "def", empty schema and tables, then name and org_name
+        col_def = b"\x03def\x00\x00\x00" + name + name + _COLUMN_DEF_TAIL
+        sequence_id = _emit(out, col_def, sequence_id)
+    _emit(out, _EOF, sequence_id)
+    return bytes(out)
+
+
+async def _handle_select(
+    server: MySQLServer,
+    writer: StreamWriter,
+    conn: Connection,
+    cursor: Cursor,
+    query: bytes,
+    sequence_id: int,
+) -> int:
+    """Execute a SELECT and send the result set to the client.
+
+    Only the client holding an open transaction reads through the shared
+    connection, so it sees its own changes; everyone else reads committed data
+    on the read connection.
+    """
+    if server._tx_owner is not cursor and server._read_db is not None:
+        cursor = server._read_db.cursor()
+    try:
+        cursor.arraysize = FETCH_BATCH_SIZE
+        await to_thread(cursor.execute, query.decode("utf-8", errors="ignore"))
+        columns = tuple(desc[0] for desc in cursor.description)
+        out = bytearray(_column_defs_block(columns, sequence_id))
+        sequence_id += len(columns) + 2
+        # Stream rows in batches so large result sets are never fully
+        # materialized; the column definitions go out with the first batch.
+        while rows := await to_thread(cursor.fetchmany):
+            for row in rows:
+                sequence_id = _emit(out, _encode_row(row), sequence_id)
+            await _flush(writer, out)
+            out = bytearray()
+        sequence_id = _emit(out, _EOF, sequence_id)
+        await _flush(writer, out)
+    except SQLiteError as e:
+        raise DatabaseError(f"SQLite query failed: {e}", e)
+    return sequence_id
+
+
+async def _handle_use(
+    server: MySQLServer,
+    writer: StreamWriter,
+    conn: Connection,
+    cursor: Cursor,
+    query: bytes,
+    sequence_id: int,
+) -> int:
+    """Acknowledge a USE statement; there is only one database."""
+    return await server.send_packet(writer, _OK, sequence_id)
+
+
+async def _handle_show(
+    server: MySQLServer,
+    writer: StreamWriter,
+    conn: Connection,
+    cursor: Cursor,
+    query: bytes,
+    sequence_id: int,
+) -> int:
+    """Answer SHOW DATABASES; other SHOW statements go to SQLite."""
+    if query.strip().translate(_TO_UPPER) != b"SHOW DATABASES":
+        return await _handle_write(server, writer, conn, cursor, query, sequence_id)
+    out = bytearray()
+    sequence_id = _emit(out, _SHOW_DB_COUNT, sequence_id)
+    sequence_id = _emit(out, _SHOW_DB_COLUMN_DEF, sequence_id)
+    sequence_id = _emit(out, _EOF, sequence_id)
+    sequence_id = _emit(out, _SHOW_DB_ROW, sequence_id)
+    sequence_id = _emit(out, _EOF, sequence_id)
+    await _flush(writer, out)
+    return sequence_id
+
+
+async def _handle_write(
+    server: MySQLServer,
+    writer: StreamWriter,
+    conn: Connection,
+    cursor: Cursor,
+    query: bytes,
+    sequence_id: int,
+) -> int:
+    """Execute a statement that returns no rows and send an OK packet.
+
+    The connection is shared, so a client that opens a transaction keeps
+    holding server._db_lock until it ends; other clients' writes wait for it.
+    Their SELECTs go to server._read_db instead and never see the uncommitted
+    changes (see _handle_select).
+    """
+    if server._tx_owner is not cursor:
+        await server._db_lock.acquire()
+    try:
+        await to_thread(cursor.execute, query.decode("utf-8", errors="ignore"))
+    except SQLiteError as e:
+        raise DatabaseError(f"SQLite command failed: {e}", e)
+    finally:
+        if conn.in_transaction:
+            server._tx_owner = cursor
+        else:
+            server._tx_owner = None
+            server._db_lock.release()
+    return await server.send_packet(writer, _OK, sequence_id)
+
+
+QueryHandler = Callable[
+    [MySQLServer, StreamWriter, Connection, Cursor, bytes, int], Awaitable[int]
+]
+
+# Statement handlers keyed by the query's leading keyword; anything not listed
+# is executed as a write by _handle_write.
+QUERY_HANDLERS: dict[bytes, QueryHandler] = {
+    b"SELECT": _handle_select,
+    b"USE": _handle_use,
+    b"SHOW": _handle_show,
+    b"INSERT": _handle_write,
+    b"UPDATE": _handle_write,
+    b"DELETE": _handle_write,
+}
+
 
 async def parse_client_packet(
     server: MySQLServer,
@@ -36,27 +282,43 @@ async def parse_client_packet(
 
     # Wait for client handshake response with a timeout
     try:
-        data = await wait_for(reader.read(1024), timeout=5.0)
+        client_seq, payload = await _read_packet(reader, 5.0, MAX_HANDSHAKE_SIZE)
     except TimeoutError:
         logger.error("Timeout waiting for client handshake response")
         return
-
-    if not data:
+    except ProtocolError as e:
+        logger.warning(f"Malformed client handshake: {e}")
+        await server.send_packet(
+            writer, b"\xff\x04\x04#28000Access denied", sequence_id + 1
+        )
+        return
+    except IncompleteReadError:
         logger.debug("No initial data received from client")
         return
 
     # Parse client handshake response
-    packet_len = int.from_bytes(data[:3], "little")
-    client_seq = data[3]
-    client_capabilities = int.from_bytes(data[4:8], "little")
-    max_packet_size = int.from_bytes(data[8:12], "little")
-    charset = data[12]
-    username_end = data.find(b"\x00", 23)
-
-    logger.debug(f"Received client packet: {data.hex()}")
-    logger.debug(
-        f"Client capabilities: {hex(client_capabilities)}, Max packet size: {max_packet_size}, Charset: {charset}"
-    )
+    if len(payload) < 32:
+        logger.warning("Malformed client handshake: packet too short")
+        await server.send_packet(
+            writer, b"\xff\x04\x04#28000Access denied", client_seq + 1
+        )
+        return
+
+    # Slicing the memoryview does not copy the underlying packet
+    mv = memoryview(payload)
+    client_capabilities = int.from_bytes(mv[0:4], "little")
+    max_packet_size = int.from_bytes(mv[4:8], "little")
+    charset = mv[8]
+    username_end = payload.find(b"\x00", 32)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received client packet: %s", payload.hex())
+        logger.debug(
+            "Client capabilities: %#x, Max packet size: %d, Charset: %d",
+            client_capabilities,
+            max_packet_size,
+            charset,
+        )
 
     if not (client_capabilities & CLIENT_PLUGIN_AUTH):
         logger.warning("Client does not support plugin authentication")
@@ -74,9 +336,9 @@ async def parse_client_packet(
         )
         return
 
-    username = data[23:username_end].decode("utf-8", errors="ignore")
-    auth_len = int.from_bytes(data[username_end + 1 : username_end + 2], "little")
-    auth_response = data[username_end + 2 : username_end + 2 + auth_len]
+    username = str(mv[32:username_end], "utf-8", errors="ignore")
+    auth_len = int.from_bytes(mv[username_end + 1 : username_end + 2], "little")
+    auth_response = mv[username_end + 2 : username_end + 2 + auth_len]
 
     # mysql_native_password authentication
     if username != server._username:
@@ -87,16 +349,18 @@ async def parse_client_packet(
         return
 
     if server._password:
-        password_hash = sha1(server._password.encode()).digest()
-        stage1 = sha1(password_hash).digest()
-        if server._auth_data is None:
+        password_hash = server._password_hash
+        stage1 = server._stage1
+        if server._auth_data is None or password_hash is None or stage1 is None:
             logger.error("Authentication data is missing")
             await server.send_packet(
                 writer, b"\xff\x04\x04#28000Access denied", client_seq + 1
             )
             return
         stage2 = sha1(server._auth_data + stage1).digest()
-        expected_response = bytes(a ^ b for a, b in zip(password_hash, stage2))
+        expected_response = (
+            int.from_bytes(password_hash, "big") ^ int.from_bytes(stage2, "big")
+        ).to_bytes(20, "big")
         if auth_response != expected_response:
             logger.warning(f"Password authentication failed for user: {username}")
             await server.send_packet(
@@ -105,98 +369,51 @@ async def parse_client_packet(
             return
 
     # Send OK packet after successful authentication
-    sequence_id = await server.send_packet(
-        writer, b"\x00\x00\x00\x02\x00\x00\x00", client_seq + 1
-    )
+    sequence_id = await server.send_packet(writer, _OK, client_seq + 1)
     logger.info(f"Client authenticated: {username}")
 
-    # SQLite connection
-    conn = connect(server._data_file)
+    # Each client gets its own cursor on the server's shared SQLite connection;
+    # calls into it run in worker threads so a slow query does not block the
+    # event loop for other clients
+    conn = server._db
+    if conn is None:
+        raise DatabaseError("Database is not open")
     cursor = conn.cursor()
 
     try:
         while True:
             try:
-                data = await wait_for(reader.read(1024), timeout=30.0)
+                client_seq, payload = await _read_packet(reader, 30.0)
             except TimeoutError:
                 logger.debug("Timeout waiting for client query")
                 break
-            if not data:
+            except IncompleteReadError:
                 logger.debug("Client disconnected")
                 break
-            packet_len = int.from_bytes(data[:3], "little")
-            client_seq = data[3]
-            query = (
-                data[4 : 4 + packet_len].decode("utf-8", errors="ignore")[1:].strip()
-            )
-            query_upper = query.upper()
-            logger.debug(f"Received query: {query}")
-
-            if query_upper.startswith("SELECT"):
-                try:
-                    cursor.execute(query)
-                    rows = cursor.fetchall()
-                    columns = [desc[0] for desc in cursor.description]
-                    sequence_id = await server.send_packet(
-                        writer, pack("B", len(columns)), client_seq + 1
-                    )
-                    for col in columns:
-                        col_def = (
-                            b"\x03def\x00\x00\x00"
-                            + pack("B", len(col))
-                            + col.encode()
-                            + b"\x0c\x21\x00\xff\x00\x00\xfc\x00\x00\x00\x00\x00"
-                        )
-                        sequence_id = await server.send_packet(
-                            writer, col_def, sequence_id
-                        )
-                    sequence_id = await server.send_packet(
-                        writer, b"\xfe\x00\x00\x02\x00", sequence_id
-                    )
-                    for row in rows:
-                        row_data = b"".join(
-                            pack("B", len(str(val).encode())) + str(val).encode()
-                            for val in row
-                        )
-                        sequence_id = await server.send_packet(
-                            writer, row_data, sequence_id
-                        )
-                    sequence_id = await server.send_packet(
-                        writer, b"\xfe\x00\x00\x02\x00", sequence_id
-                    )
-                except SQLiteError as e:
-                    raise DatabaseError(f"SQLite query failed: {e}", e)
-            elif query_upper.startswith("USE"):
-                sequence_id = await server.send_packet(
-                    writer, b"\x00\x00\x00\x02\x00\x00\x00", client_seq + 1
-                )
-            elif query_upper == "SHOW DATABASES":
-                sequence_id = await server.send_packet(writer, b"\x01", client_seq + 1)
-                sequence_id = await server.send_packet(
-                    writer,
-                    b"\x03def\x00\x00\x00\x08Database\x00\x0c\x21\x00\xff\x00\x00\xfc\x00\x00\x00\x00\x00",
-                    sequence_id,
-                )
-                sequence_id = await server.send_packet(
-                    writer, b"\xfe\x00\x00\x02\x00", sequence_id
-                )
-                sequence_id = await server.send_packet(
-                    writer, b"\x07sqlite3", sequence_id
+            query = payload[1:]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Received query: %s", query.decode("utf-8", errors="ignore")
                 )
-                sequence_id = await server.send_packet(
-                    writer, b"\xfe\x00\x00\x02\x00", sequence_id
-                )
-            else:
-                try:
-                    cursor.execute(query)
-                    conn.commit()
-                    sequence_id = await server.send_packet(
-                        writer, b"\x00\x00\x00\x02\x00\x00\x00", client_seq + 1
-                    )
-                except SQLiteError as e:
-                    raise DatabaseError(f"SQLite command failed: {e}", e)
+
+            # Classify on the raw bytes; the query is only decoded when it is
+            # handed to SQLite
+            match = _VERB.match(query)
+            verb = match.group(1).translate(_TO_UPPER) if match else b""
+            handler = QUERY_HANDLERS.get(verb, _handle_write)
+            sequence_id = await handler(
+                server, writer, conn, cursor, query, client_seq + 1
+            )
 
     finally:
-        conn.close()
+        if server._tx_owner is cursor:
+            # Don't leave the shared connection inside this client's transaction
+            logger.warning(f"Rolling back transaction left open by {username}")
+            try:
+                await to_thread(conn.rollback)
+            finally:
+                server._tx_owner = None
+                server._db_lock.release()
+        cursor.close()
         writer.close()
         await writer.wait_closed()
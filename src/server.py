@@ -1,15 +1,28 @@
-from asyncio import start_server, StreamReader, StreamWriter, Server, TimeoutError
+from asyncio import (
+    start_server,
+    to_thread,
+    Lock,
+    StreamReader,
+    StreamWriter,
+    Server,
+    TimeoutError,
+)
 from struct import pack
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from hashlib import sha1
+from socket import IPPROTO_TCP, SO_SNDBUF, SOL_SOCKET, TCP_NODELAY
+from sqlite3 import connect, Connection, Cursor, Error as SQLiteError
 from typing import Optional, Self
 
 import os
 import logging
 
-from errors import ConnectionError, ProtocolError
+from errors import ConnectionError, DatabaseError, ProtocolError
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
+
+# Kernel send buffer for client sockets, sized for batched result sets
+SEND_BUFFER_SIZE = 256 * 1024
 
 
 @dataclass
@@ -23,11 +36,18 @@ class MySQLServer:
     _server_version: str = "5.7.0-custom"
     _auth_plugin: str = "mysql_native_password"
     _auth_data: Optional[bytes] = None
+    _password_hash: Optional[bytes] = None  # SHA1(password)
+    _stage1: Optional[bytes] = None  # SHA1(SHA1(password))
+    _handshake_payload: Optional[bytes] = None  # Built by config()
     _capability_flags: int = 0xA0D7FF  # CLIENT_LONG_PASSWORD | CLIENT_FOUND_ROWS | CLIENT_LONG_FLAG | CLIENT_CONNECT_WITH_DB | CLIENT_PROTOCOL_41 | CLIENT_SECURE_CONNECTION | CLIENT_PLUGIN_AUTH
     _charset: int = 33  # UTF-8 (utf8mb4)
     _status_flags: int = 0x0002  # SERVER_STATUS_AUTOCOMMIT
     _data_file: str = "/tmp/sqlite.db"
     server: Optional[Server] = None
+    _db: Optional[Connection] = None  # SQLite connection shared by all clients
+    _read_db: Optional[Connection] = None  # Committed-only reads for SELECTs
+    _db_lock: Lock = field(default_factory=Lock)  # Serializes data changes
+    _tx_owner: Optional[Cursor] = None  # Client cursor holding an open transaction
 
     def config(
         self,
@@ -48,6 +68,11 @@ class MySQLServer:
         self._port = port if port is not None else self._port
         self._username = username if username is not None else self._username
         self._password = password if password is not None else self._password
+        if self._password:
+            self._password_hash = sha1(self._password.encode()).digest()
+            self._stage1 = sha1(self._password_hash).digest()
+        else:
+            self._password_hash = self._stage1 = None
         self._server_version = (
             server_version if server_version is not None else self._server_version
         )
@@ -71,74 +96,135 @@ class MySQLServer:
         elif len(self._auth_data) < 20:
             self._auth_data = self._auth_data.ljust(20, b"\x00")[:20]
 
+        self._handshake_payload = self._build_handshake()
         return self
 
-    async def send_packet(
+    def _build_handshake(self) -> bytes:
+        """Build the initial handshake packet payload (Protocol 10)."""
+        handshake = bytearray(b"\x0a")  # Protocol version 10
+        handshake += self._server_version.encode()
+        handshake += b"\x00"  # Server version, null-terminated
+        handshake += pack("<I", 1)  # Connection ID
+        handshake += (
+            self._auth_data[:8] if self._auth_data else b"\x00" * 8
+        )  # Auth plugin data part 1 (8 bytes)
+        handshake += b"\x00"  # Filler
+        handshake += pack("<H", self._capability_flags & 0xFFFF)  # Lower capabilities
+        handshake += pack("B", self._charset)  # Character set
+        handshake += pack("<H", self._status_flags)  # Status flags
+        handshake += pack("<H", self._capability_flags >> 16)  # Upper capabilities
+        handshake += pack("B", 21)  # Auth plugin data length (20 + null terminator)
+        handshake += b"\x00" * 10  # Reserved
+        handshake += (
+            self._auth_data[8:] if self._auth_data else b"\x00" * 12
+        )  # Auth plugin data part 2 (remaining 12 bytes)
+        handshake += self._auth_plugin.encode()
+        handshake += b"\x00"  # Auth plugin name, null-terminated
+        return bytes(handshake)
+
+    def send_packet_nodrain(
         self, writer: StreamWriter, payload: bytes, sequence_id: int
     ) -> int:
-        """Send a MySQL protocol packet to the client."""
+        """Queue a MySQL protocol packet without waiting for it to be flushed."""
         if len(payload) > 0xFFFFFF:
             raise ProtocolError("Payload exceeds MySQL packet size limit")
-        packet = pack("<I", len(payload))[:3] + pack("B", sequence_id) + payload
+        header = len(payload).to_bytes(3, "little") + bytes((sequence_id & 0xFF,))
+        try:
+            # Header and payload share the transport buffer (and a single
+            # sendmsg() where supported) without being concatenated first
+            writer.writelines((header, payload))
+        except OSError as e:
+            raise ConnectionError(f"Failed to send packet: {e}")
+        return sequence_id + 1
+
+    async def send_packet(
+        self, writer: StreamWriter, payload: bytes, sequence_id: int
+    ) -> int:
+        """Send a MySQL protocol packet to the client."""
+        sequence_id = self.send_packet_nodrain(writer, payload, sequence_id)
         try:
-            writer.write(packet)
             await writer.drain()
         except (OSError, TimeoutError) as e:
             raise ConnectionError(f"Failed to send packet: {e}")
-        return sequence_id + 1
+        return sequence_id
 
     async def handle_client(self, reader: StreamReader, writer: StreamWriter) -> None:
         """Handle an incoming client connection with MySQL handshake."""
         client_addr = writer.get_extra_info("peername") or ("unknown", "unknown")
         logger.info(f"Client connected - IP: {client_addr[0]}, Port: {self._port}")
 
-        # Construct initial handshake packet (Protocol 10)
-        handshake = (
-            b"\x0a"  # Protocol version 10
-            + self._server_version.encode()
-            + b"\x00"  # Server version, null-terminated
-            + pack("<I", 1)  # Connection ID
-            + (
-                self._auth_data[:8] if self._auth_data else b"\x00" * 8
-            )  # Auth plugin data part 1 (8 bytes)
-            + b"\x00"  # Filler
-            + pack("<H", self._capability_flags & 0xFFFF)  # Lower capability flags
-            + pack("B", self._charset)  # Character set
-            + pack("<H", self._status_flags)  # Status flags
-            + pack("<H", self._capability_flags >> 16)  # Upper capability flags
-            + pack(
-                "B", 21
-            )  # Auth plugin data length (20 bytes + 1 for null terminator)
-            + b"\x00" * 10  # Reserved
-            + (
-                self._auth_data[8:] if self._auth_data else b"\x00" * 12
-            )  # Auth plugin data part 2 (remaining 12 bytes)
-            + self._auth_plugin.encode()
-            + b"\x00"  # Auth plugin name, null-terminated
-        )
-        logger.debug(f"Sending handshake packet: {handshake.hex()}")
-        sequence_id = await self.send_packet(writer, handshake, 0)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            try:
+                sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                sock.setsockopt(SOL_SOCKET, SO_SNDBUF, SEND_BUFFER_SIZE)
+            except OSError as e:
+                logger.warning(f"Failed to set socket options: {e}")
+
+        handshake = self._handshake_payload or self._build_handshake()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending handshake packet: %s", handshake.hex())
+        # Nothing more is sent until the client replies, so skip the drain
+        sequence_id = self.send_packet_nodrain(writer, handshake, 0)
 
         from parser import parse_client_packet
 
         await parse_client_packet(self, reader, writer, sequence_id)
 
+    def _connect(self) -> Connection:
+        """Open a SQLite connection to the data file with the shared PRAGMAs."""
+        db = connect(self._data_file, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA synchronous=NORMAL")  # No fsync per commit under WAL
+        db.execute("PRAGMA temp_store=MEMORY")
+        db.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+        db.execute("PRAGMA mmap_size=268435456")  # Map up to 256 MiB of the file
+        return db
+
+    def _open_database(self) -> tuple[Connection, Connection]:
+        """Open the shared write connection and the read connection for SELECTs."""
+        db = self._connect()
+        # WAL is persistent in the database file and lets the read connection
+        # see only committed data without blocking on the writer
+        db.execute("PRAGMA journal_mode=WAL")
+        try:
+            read_db = self._connect()
+            read_db.execute("PRAGMA query_only=ON")
+        except SQLiteError:
+            db.close()
+            raise
+        return db, read_db
+
     async def start(self) -> None:
         """Start the server on the configured host and port."""
         if self.server is not None:
             raise RuntimeError("Server is already running")
+        try:
+            self._db, self._read_db = await to_thread(self._open_database)
+        except SQLiteError as e:
+            raise DatabaseError(f"Failed to open {self._data_file}: {e}", e)
         try:
             self.server = await start_server(self.handle_client, self._host, self._port)
             await self.server.serve_forever()
         except OSError as e:
+            await self._close_database()
             raise ConnectionError(f"Failed to start server: {e}")
 
+    async def _close_database(self) -> None:
+        """Close the shared SQLite connections if they are open."""
+        if self._read_db is not None:
+            await to_thread(self._read_db.close)
+            self._read_db = None
+        if self._db is not None:
+            await to_thread(self._db.close)
+            self._db = None
+
     async def stop(self) -> None:
         """Stop the server and close all connections."""
         if self.server is not None:
             self.server.close()
             await self.server.wait_closed()
             self.server = None
+        await self._close_database()
 
     async def __aenter__(self) -> "MySQLServer":
         await self.start()
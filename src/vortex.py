@@ -24,12 +24,17 @@ from os import makedirs, path
 from sys import exit
 from typing import Dict, Optional
 from argparse import ArgumentParser
-from logging import basicConfig, getLogger, DEBUG, StreamHandler
+from logging import basicConfig, getLogger, DEBUG, INFO, StreamHandler
 from toml import load, dump, TomlDecodeError
 
 from server import MySQLServer
 from errors import ConfigError
 
+try:
+    import uvloop  # type: ignore[import-not-found, unused-ignore]
+except ImportError:  # Optional speedup, not available on Windows
+    uvloop = None  # type: ignore[assignment, unused-ignore]
+
 # Constants
 DEFAULT_CONFIG_PATH = path.expanduser("~/.config/vortex/config.toml")
 DEFAULT_CONFIG_DIR = path.dirname(DEFAULT_CONFIG_PATH)
@@ -46,12 +51,6 @@ DEFAULT_CONFIG = {
     }
 }
 
-# Configure logging
-basicConfig(
-    level=DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[StreamHandler()],
-)
 logger = getLogger("vortex")
 
 
@@ -166,10 +165,13 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    # Set logging level
-    if args.verbose:
-        logger.setLevel(DEBUG)
-        logger.debug("Verbose logging enabled")
+    # Configure logging; library modules only create loggers
+    basicConfig(
+        level=DEBUG if args.verbose else INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[StreamHandler()],
+    )
+    logger.debug("Verbose logging enabled")
 
     # Handle config creation
     if args.create_config or not path.exists(args.config):
@@ -222,7 +224,9 @@ def main() -> None:
     # Start the server
     try:
         logger.info("Initializing Vortex server...")
-        run(run_server())
+        if uvloop is not None:
+            logger.debug("Using uvloop event loop")
+        run(run_server(), loop_factory=uvloop.new_event_loop if uvloop else None)
     except KeyboardInterrupt:
         logger.info("Received shutdown signal, stopping server...")
     except Exception as e:
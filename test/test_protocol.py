@@ -0,0 +1,65 @@
+"""Tests for statement classification and result set encoding."""
+
+import pytest
+
+from parser import (
+    QUERY_HANDLERS,
+    _TO_UPPER,
+    _VERB,
+    _column_defs_block,
+    _encode_row,
+)
+
+
+@pytest.mark.parametrize(
+    ("query", "verb"),
+    [
+        (b"select*from t", b"SELECT"),
+        (b"SELECT(1)", b"SELECT"),
+        (b"\n" * 20 + b"use x", b"USE"),
+        (b"USER", b"USER"),  # Not a prefix match for USE
+    ],
+)
+def test_verb(query: bytes, verb: bytes) -> None:
+    match = _VERB.match(query)
+    assert match is not None
+    assert match.group(1).translate(_TO_UPPER) == verb
+
+
+def test_user_is_not_dispatched_as_use() -> None:
+    assert b"USER" not in QUERY_HANDLERS
+
+
+@pytest.mark.parametrize(
+    ("row", "payload"),
+    [
+        (
+            (1, None, 2.5, b"\x00", "x" * 300),
+            b"\x011"
+            + b"\xfb"
+            + b"\x032.5"
+            + b"\x01\x00"
+            + b"\xfc\x2c\x01"
+            + b"x" * 300,
+        ),
+        ((), b""),
+        ((None, None), b"\xfb\xfb"),
+        (("é",), b"\x02\xc3\xa9"),
+    ],
+)
+def test_encode_row(row: tuple[object, ...], payload: bytes) -> None:
+    assert _encode_row(row) == payload
+
+
+def test_column_defs_block() -> None:
+    column_count = b"\x01\x00\x00\x01" + b"\x01"
+    column_def = (
+        b"\x18\x00\x00\x02"
+        + b"\x03def"  # Catalog
+        + b"\x00\x00\x00"  # Schema, table, org_table
+        + b"\x01a"  # Name
+        + b"\x01a"  # Org_name
+        + b"\x0c\x21\x00\xff\x00\x00\x00\xfc\x00\x00\x00\x00\x00"
+    )
+    eof = b"\x05\x00\x00\x03" + b"\xfe\x00\x00\x02\x00"
+    assert _column_defs_block(("a",), 1) == column_count + column_def + eof
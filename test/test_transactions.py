@@ -0,0 +1,227 @@
+"""Tests for transactions on the SQLite connection shared by all clients."""
+
+import asyncio
+import sqlite3
+from asyncio import IncompleteReadError, StreamReader, StreamWriter
+from collections.abc import AsyncIterator, Awaitable, Callable
+from pathlib import Path
+
+import pytest
+
+from errors import DatabaseError
+from server import MySQLServer
+
+pytestmark = pytest.mark.anyio
+
+OK = b"\x00\x00\x00\x02\x00\x00\x00"
+CLIENT_PROTOCOL_41 = 0x00000200
+CLIENT_SECURE_CONNECTION = 0x00008000
+CLIENT_PLUGIN_AUTH = 0x00080000
+
+Client = tuple[StreamReader, StreamWriter]
+Connect = Callable[[], Awaitable[Client]]
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture
+def data_file(tmp_path: Path) -> str:
+    path = str(tmp_path / "vortex.db")
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE t (x INTEGER)")
+    return path
+
+
+@pytest.fixture
+async def server(data_file: str) -> AsyncIterator[MySQLServer]:
+    server = MySQLServer().config(host="127.0.0.1", port=0, data_file=data_file)
+    task = asyncio.create_task(server.start())
+    while server.server is None or not server.server.is_serving():
+        await asyncio.sleep(0.01)
+    yield server
+    await server.stop()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+@pytest.fixture
+async def connect(server: MySQLServer) -> AsyncIterator[Connect]:
+    """Open logged-in client connections, closed before the server stops."""
+    writers: list[StreamWriter] = []
+
+    async def connect() -> Client:
+        assert server.server is not None
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writers.append(writer)
+        await read_packet(reader)  # Handshake
+        # No password is configured, so the auth response is left empty
+        capabilities = (
+            CLIENT_PROTOCOL_41 | CLIENT_SECURE_CONNECTION | CLIENT_PLUGIN_AUTH
+        )
+        response = (
+            capabilities.to_bytes(4, "little")
+            + (1 << 24).to_bytes(4, "little")
+            + b"\x21"
+            + b"\x00" * 23
+            + server._username.encode()
+            + b"\x00\x00"
+        )
+        writer.write(len(response).to_bytes(3, "little") + b"\x01" + response)
+        assert await read_packet(reader) == OK
+        return reader, writer
+
+    yield connect
+    for writer in writers:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+@pytest.fixture
+async def handler_errors() -> AsyncIterator[list[BaseException]]:
+    """Collect exceptions that end a client handler instead of failing the test."""
+    errors: list[BaseException] = []
+    loop = asyncio.get_running_loop()
+    previous = loop.get_exception_handler()
+    loop.set_exception_handler(
+        lambda loop, context: errors.append(context["exception"])
+    )
+    yield errors
+    loop.set_exception_handler(previous)
+
+
+async def read_packet(reader: StreamReader) -> bytes:
+    header = await reader.readexactly(4)
+    return await reader.readexactly(int.from_bytes(header[:3], "little"))
+
+
+async def query(reader: StreamReader, writer: StreamWriter, sql: str) -> bytes:
+    """Send a COM_QUERY and return the first response packet."""
+    payload = b"\x03" + sql.encode()
+    writer.write(len(payload).to_bytes(3, "little") + b"\x00" + payload)
+    return await read_packet(reader)
+
+
+async def count(reader: StreamReader, writer: StreamWriter) -> int:
+    """Return SELECT count(*) FROM t as seen by this client."""
+    assert await query(reader, writer, "SELECT count(*) FROM t") == b"\x01"
+    await read_packet(reader)  # Column definition
+    await read_packet(reader)  # EOF
+    row = await read_packet(reader)
+    await read_packet(reader)  # EOF
+    return int(row[1 : 1 + row[0]])
+
+
+def committed_count(data_file: str) -> int:
+    with sqlite3.connect(data_file) as db:
+        return int(db.execute("SELECT count(*) FROM t").fetchone()[0])
+
+
+async def wait_for_release(server: MySQLServer) -> None:
+    while server._tx_owner is not None or server._db_lock.locked():
+        await asyncio.sleep(0.01)
+
+
+async def test_write_waits_for_open_transaction(
+    server: MySQLServer, data_file: str, connect: Connect
+) -> None:
+    a = await connect()
+    b = await connect()
+    assert await query(*a, "BEGIN") == OK
+    assert await query(*a, "INSERT INTO t VALUES (1)") == OK
+
+    pending = asyncio.create_task(query(*b, "INSERT INTO t VALUES (2)"))
+    await asyncio.sleep(0.2)
+    assert not pending.done()
+    assert committed_count(data_file) == 0
+
+    assert await query(*a, "COMMIT") == OK
+    assert await asyncio.wait_for(pending, 5) == OK
+    assert committed_count(data_file) == 2
+    assert server._tx_owner is None
+    assert not server._db_lock.locked()
+
+
+async def test_owner_reenters_its_transaction(
+    server: MySQLServer, data_file: str, connect: Connect
+) -> None:
+    a = await connect()
+    for sql in ("BEGIN", "INSERT INTO t VALUES (1)", "INSERT INTO t VALUES (2)"):
+        assert await asyncio.wait_for(query(*a, sql), 5) == OK
+    assert await asyncio.wait_for(count(*a), 5) == 2
+    assert await asyncio.wait_for(query(*a, "COMMIT"), 5) == OK
+    assert committed_count(data_file) == 2
+    assert server._tx_owner is None
+    assert not server._db_lock.locked()
+
+
+async def test_other_clients_read_committed_data(
+    server: MySQLServer, connect: Connect
+) -> None:
+    a = await connect()
+    b = await connect()
+    assert await query(*a, "BEGIN") == OK
+    assert await query(*a, "INSERT INTO t VALUES (1)") == OK
+    assert await asyncio.wait_for(count(*b), 5) == 0
+    assert await count(*a) == 1
+    assert await query(*a, "COMMIT") == OK
+    assert await count(*b) == 1
+
+
+async def test_disconnect_rolls_back_open_transaction(
+    server: MySQLServer, data_file: str, connect: Connect
+) -> None:
+    a = await connect()
+    assert await query(*a, "BEGIN") == OK
+    assert await query(*a, "INSERT INTO t VALUES (1)") == OK
+    a[1].close()
+    await a[1].wait_closed()
+
+    await asyncio.wait_for(wait_for_release(server), 5)
+    assert committed_count(data_file) == 0
+    b = await connect()
+    assert await asyncio.wait_for(query(*b, "INSERT INTO t VALUES (2)"), 5) == OK
+    assert committed_count(data_file) == 1
+
+
+async def test_failed_statement_in_transaction_releases_lock(
+    server: MySQLServer,
+    data_file: str,
+    connect: Connect,
+    handler_errors: list[BaseException],
+) -> None:
+    a = await connect()
+    assert await query(*a, "BEGIN") == OK
+    assert await query(*a, "INSERT INTO t VALUES (1)") == OK
+    # The failed statement drops the client, which rolls back its transaction
+    with pytest.raises(IncompleteReadError):
+        await query(*a, "INSERT INTO missing VALUES (1)")
+
+    await asyncio.wait_for(wait_for_release(server), 5)
+    assert committed_count(data_file) == 0
+    assert [type(e) for e in handler_errors] == [DatabaseError]
+    b = await connect()
+    assert await asyncio.wait_for(query(*b, "INSERT INTO t VALUES (2)"), 5) == OK
+    assert committed_count(data_file) == 1
+
+
+async def test_failed_autocommit_statement_releases_lock(
+    server: MySQLServer, connect: Connect, handler_errors: list[BaseException]
+) -> None:
+    a = await connect()
+    with pytest.raises(IncompleteReadError):
+        await query(*a, "INSERT INTO missing VALUES (1)")
+
+    await asyncio.wait_for(wait_for_release(server), 5)
+    assert [type(e) for e in handler_errors] == [DatabaseError]
+    b = await connect()
+    assert await asyncio.wait_for(query(*b, "INSERT INTO t VALUES (1)"), 5) == OK